@@ -82,6 +82,8 @@ pub struct RedisGraphClient {
     connection: ConnectionManager,
     redis_url: String,
     request_channel: String,
+    /// Number of request channel shards (REQUEST_SHARDS); 1 disables sharding
+    request_shards: u32,
     response_channel: String,
 }
 
@@ -90,6 +92,19 @@ impl RedisGraphClient {
     pub async fn new(redis_url: &str) -> Result<Self> {
         info!("Connecting to Redis at {}", redis_url);
 
+        // Parsed the same way as vagent-graph (surrounding whitespace ignored,
+        // 0 or unset meaning unsharded); anything else is a configuration
+        // error, since silently falling back to 1 would publish every request
+        // to a channel no vagent-graph instance listens on
+        let request_shards = match std::env::var("REQUEST_SHARDS") {
+            Ok(value) if !value.trim().is_empty() => value
+                .trim()
+                .parse::<u32>()
+                .with_context(|| format!("Invalid REQUEST_SHARDS {:?}", value))?
+                .max(1),
+            _ => 1,
+        };
+
         let client = Client::open(redis_url).context("Failed to create Redis client")?;
 
         let connection = ConnectionManager::new(client)
@@ -100,10 +115,24 @@ impl RedisGraphClient {
             connection,
             redis_url: redis_url.to_string(),
             request_channel: "vagent:requests".to_string(),
+            request_shards,
             response_channel: "vagent:responses".to_string(),
         })
     }
 
+    /// Channel a request is published on
+    ///
+    /// With sharding enabled, requests are spread over `vagent:requests:{k}`
+    /// by request ID so several vagent-graph instances can each consume a
+    /// subset of the shards (see REQUEST_SHARDS_OWNED in vagent-graph)
+    fn request_channel_for(&self, request_uuid: &Uuid) -> String {
+        if self.request_shards <= 1 {
+            return self.request_channel.clone();
+        }
+        let shard = request_uuid.as_u128() % u128::from(self.request_shards);
+        format!("{}:{}", self.request_channel, shard)
+    }
+
     /// Send a query to vagent-graph with streaming support
     ///
     /// The on_progress callback is called for each progress notification
@@ -118,7 +147,8 @@ impl RedisGraphClient {
     where
         F: Fn(String) + Send + 'static,
     {
-        let request_id = Uuid::new_v4().to_string();
+        let request_uuid = Uuid::new_v4();
+        let request_id = request_uuid.to_string();
 
         let request = GraphRequest {
             request_id: request_id.clone(),
@@ -146,8 +176,9 @@ impl RedisGraphClient {
         // Now serialize and publish request
         let request_json = serde_json::to_string(&request).context("Failed to serialize request")?;
 
+        let request_channel = self.request_channel_for(&request_uuid);
         self.connection
-            .publish::<_, _, ()>(&self.request_channel, &request_json)
+            .publish::<_, _, ()>(&request_channel, &request_json)
             .await
             .context("Failed to publish request to Redis")?;
 
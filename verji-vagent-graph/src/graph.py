@@ -2,105 +2,281 @@
 LangGraph workflow for Verji vAgent.
 
 This module implements a simple conversational agent using LangGraph with OpenAI,
-demonstrating streaming progress updates at each node.
+streaming progress updates while the response is generated.
 """
 
+import asyncio
+import functools
 import logging
-from typing import TypedDict, Annotated, Sequence
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from langchain_openai import ChatOpenAI
+import os
+from typing import TYPE_CHECKING, AsyncIterator, TypedDict, Annotated, Optional, Sequence
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+)
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 
+from llm_batcher import BatchingLLM
+from llm_cache import LLMCache
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _get_rate_limiter() -> InMemoryRateLimiter:
+    """
+    Return the process-wide OpenAI request rate limiter.
+
+    All LLM clients in this process share it, so this instance stays under
+    OPENAI_RPM requests per minute. The bucket is per process: with several
+    vagent-graph instances (e.g. sharded), the total is instances x OPENAI_RPM.
+
+    Raises:
+        ValueError: If OPENAI_RPM is not positive (the bucket would never refill)
+    """
+    rpm = int(os.getenv("OPENAI_RPM", "500"))
+    if rpm <= 0:
+        raise ValueError(f"OPENAI_RPM must be positive, got {rpm}")
+    requests_per_second = rpm / 60
+    return InMemoryRateLimiter(
+        requests_per_second=requests_per_second,
+        max_bucket_size=max(1, int(requests_per_second)),  # allow ~1s of burst
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_llm(model: str, temperature: float) -> "ChatOpenAI":
+    """
+    Return a shared ChatOpenAI client for the given model settings.
+
+    Reusing one client per (model, temperature) lets its pooled HTTP
+    transport keep connections to OpenAI alive across agents and requests.
+    langchain_openai (and the OpenAI SDK, httpx and tiktoken behind it) is
+    imported here rather than at module level, keeping it off the startup
+    path until the first LLM call.
+    """
+    from langchain_openai import ChatOpenAI
+
+    # streaming is left unset: calls stream tokens only when the graph runs
+    # with stream_mode="messages" (see VerjiAgent.process_stream)
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        # Rate-limit (429), server and connection errors are retried with
+        # exponential backoff and jitter by the OpenAI client
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "5")),
+        rate_limiter=_get_rate_limiter(),
+    )
+
+
 class AgentState(TypedDict):
     """State for the agent workflow."""
     messages: Annotated[Sequence[BaseMessage], add_messages]
     request_id: str
+    # Matrix room the request came from; scopes request batching
+    room_id: str
+    # Set by process_stream; the response is streamed token by token
+    stream: bool
 
 
 class VerjiAgent:
     """LangGraph-based conversational agent with streaming progress."""
 
-    def __init__(self, emit_progress_callback):
+    # Static prompt prefix. It is always sent first and never changes; any
+    # per-request context must come after it.
+    _STATIC_SYSTEM = SystemMessage(
+        content=(
+            "You are Verji vAgent, a helpful AI assistant taking part in a Matrix chat room. "
+            "Answer clearly and concisely."
+        )
+    )
+
+    def __init__(
+        self,
+        emit_progress_callback,
+        cache: Optional[LLMCache] = None,
+    ):
         """
         Initialize the agent.
 
         Args:
             emit_progress_callback: Async function(request_id, content) to emit progress
+            cache: Optional response cache, used only for deterministic (temperature 0) calls
         """
         self.emit_progress = emit_progress_callback
-        self.llm = ChatOpenAI(
-            model="gpt-4o-mini",
-            temperature=0.7,
-            streaming=False,  # We'll handle streaming via progress updates
-        )
+        self.cache = cache
+        # Number of most recent conversation messages sent to the LLM; at least
+        # the current question (a slice of [-0:] would send everything)
+        self.max_history = max(1, int(os.getenv("MAX_HISTORY", "20")))
+        # Prompt key -> pending completion, shared by concurrent identical prompts
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.temperature = float(os.getenv("LLM_TEMPERATURE", "0.7"))
+        # Created now rather than on the first LLM call, so a bad OPENAI_RPM
+        # stops the service at startup
+        _get_rate_limiter()
+        # The compiled graph is shared by all agents; each run names its agent
         self.graph = self._build_graph()
+        self._run_config: RunnableConfig = {"configurable": {"agent": self}}
 
-    def _build_graph(self) -> StateGraph:
-        """Build the LangGraph workflow."""
+    @functools.cached_property
+    def llm(self) -> "ChatOpenAI":
+        """LLM client, created on first use."""
+        return _get_llm("gpt-4o-mini", self.temperature)
+
+    @functools.cached_property
+    def batcher(self) -> Optional[BatchingLLM]:
+        """Opt-in batcher marshalling concurrent first-turn questions into shared LLM calls."""
+        batch_window_ms = int(os.getenv("LLM_BATCH_WINDOW_MS", "0"))
+        if batch_window_ms <= 0:
+            return None
+        return BatchingLLM(
+            self.llm,
+            window=batch_window_ms / 1000,
+            max_batch=int(os.getenv("LLM_BATCH_MAX", "8")),
+        )
+
+    async def aclose(self) -> None:
+        """Stop background work: the batcher's collector and any batches in flight."""
+        batcher = self.__dict__.get("batcher")  # only if it was ever created
+        if batcher is not None:
+            await batcher.aclose()
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _build_graph(cls) -> StateGraph:
+        """
+        Build the LangGraph workflow, compiled once per class.
+
+        The topology is static, so instances share one compiled graph. Nodes
+        are not bound to an instance; they find the agent in the run config.
+        """
         workflow = StateGraph(AgentState)
 
         # Add nodes
-        workflow.add_node("analyze", self._analyze_node)
-        workflow.add_node("think", self._think_node)
-        workflow.add_node("respond", self._respond_node)
+        workflow.add_node("respond", cls._respond)
 
         # Define edges
-        workflow.set_entry_point("analyze")
-        workflow.add_edge("analyze", "think")
-        workflow.add_edge("think", "respond")
+        workflow.set_entry_point("respond")
         workflow.add_edge("respond", END)
 
         return workflow.compile()
 
-    async def _analyze_node(self, state: AgentState) -> AgentState:
-        """Analyze the user's question."""
-        await self.emit_progress(
-            state["request_id"],
-            "🔍 Analyzing your question..."
-        )
+    @staticmethod
+    async def _respond(state: AgentState, config: RunnableConfig) -> dict:
+        """Graph entry for the respond step, dispatched to the running agent."""
+        return await config["configurable"]["agent"]._respond_node(state)
+
+    async def _respond_node(self, state: AgentState) -> dict:
+        """Generate response using LLM."""
+        # All progress steps are announced up front. Emitting only queues
+        # them for the publisher, so no Redis round trip sits between them.
+        for progress in (
+            "🔍 Analyzing your question...",
+            "🧠 Thinking about the best response...",
+            "✍️ Formulating answer...",
+        ):
+            await self.emit_progress(state["request_id"], progress)
         logger.info(f"[{state['request_id']}] Analyzing: {state['messages'][-1].content}")
-        return state
 
-    async def _think_node(self, state: AgentState) -> AgentState:
-        """Think about the best response."""
-        await self.emit_progress(
-            state["request_id"],
-            "🧠 Thinking about the best response..."
+        # Call OpenAI LLM (or reuse a cached completion)
+        history = state["messages"][-self.max_history:]
+        llm_messages = [self._STATIC_SYSTEM, *history]
+        # Only a lone question is independent enough to share a batched call,
+        # and only with questions from the same room. Streamed calls are never
+        # batched: the shared call's tokens would all stream to whichever
+        # request started the batch.
+        room_id = state.get("room_id", "")
+        batchable = len(state["messages"]) <= 1 and not state.get("stream", False) and bool(room_id)
+        content = await self._invoke_llm(
+            state["request_id"], llm_messages, batch_group=room_id if batchable else None
         )
-        logger.info(f"[{state['request_id']}] Thinking...")
-        return state
 
-    async def _respond_node(self, state: AgentState) -> AgentState:
-        """Generate response using LLM."""
-        await self.emit_progress(
-            state["request_id"],
-            "✍️ Formulating answer..."
-        )
+        logger.info(f"[{state['request_id']}] LLM response: {content}")
 
-        # Get the user's message
-        user_message = state["messages"][-1].content
+        # Return only the new message; the add_messages reducer appends it,
+        # so the unchanged fields are not re-written to the state
+        return {"messages": [AIMessage(content=content)]}
 
-        # Call OpenAI LLM
-        logger.info(f"[{state['request_id']}] Calling OpenAI...")
-        response = await self.llm.ainvoke(state["messages"])
+    async def _invoke_llm(
+        self,
+        request_id: str,
+        llm_messages: list[BaseMessage],
+        batch_group: Optional[str] = None,
+    ) -> str:
+        """
+        Get the LLM completion for a prompt, consulting the response cache.
 
-        # Add AI response to messages
-        state["messages"].append(AIMessage(content=response.content))
+        Sampled completions (temperature > 0) are never cached, since
+        replaying them would hide the variation the temperature asks for.
+        Identical prompts that are in flight at the same time always share
+        a single LLM call.
 
-        logger.info(f"[{state['request_id']}] LLM response: {response.content}")
-        return state
+        Args:
+            request_id: Request identifier for logging
+            llm_messages: Prompt messages to send to the LLM
+            batch_group: Room whose concurrent prompts this one may be batched
+                with, or None to never batch it
 
-    async def process(self, request_id: str, user_message: str) -> str:
+        Returns:
+            The completion content
+        """
+        key = LLMCache.cache_key(self.llm.model_name, llm_messages, self.llm.temperature)
+        cacheable = self.cache is not None and self.llm.temperature == 0
+        if cacheable:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                logger.info(f"[{request_id}] LLM cache hit")
+                return cached
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            logger.info(f"[{request_id}] Joining identical in-flight LLM call")
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            logger.info(f"[{request_id}] Calling OpenAI...")
+            if batch_group is not None and self.batcher is not None:
+                content = await self.batcher.ainvoke(llm_messages, batch_group)
+            else:
+                content = (await self.llm.ainvoke(llm_messages)).content
+        except asyncio.CancelledError:
+            # Fail joined requests with a regular error rather than cancelling
+            # them: CancelledError would get past their error handling, so
+            # they would never report back and their workers would exit
+            future.set_exception(RuntimeError("shared LLM call was cancelled"))
+            future.exception()  # mark retrieved in case nobody joined
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved in case nobody joined
+            raise
+        finally:
+            del self._inflight[key]
+
+        future.set_result(content)
+        if cacheable:
+            await self.cache.set(key, content)
+        return content
+
+    async def process(self, request_id: str, user_message: str, room_id: str = "") -> str:
         """
         Process a user message through the graph.
 
         Args:
             request_id: Unique request identifier
             user_message: The user's message
+            room_id: Matrix room the message was sent in
 
         Returns:
             The final AI response
@@ -109,15 +285,62 @@ class VerjiAgent:
         initial_state = {
             "messages": [HumanMessage(content=user_message)],
             "request_id": request_id,
+            "room_id": room_id,
         }
 
         # Run the graph
         logger.info(f"[{request_id}] Starting graph execution")
-        final_state = await self.graph.ainvoke(initial_state)
-
-        # Extract the final AI message
-        ai_messages = [msg for msg in final_state["messages"] if isinstance(msg, AIMessage)]
-        if ai_messages:
-            return ai_messages[-1].content
-        else:
-            return "I apologize, but I couldn't generate a response."
+        final_state = await self.graph.ainvoke(initial_state, config=self._run_config)
+
+        return self._final_answer(final_state)
+
+    async def process_stream(
+        self, request_id: str, user_message: str, room_id: str = ""
+    ) -> AsyncIterator[str]:
+        """
+        Process a user message through the graph, yielding the response as it is generated.
+
+        Tokens are yielded as the LLM produces them. A response that was not
+        generated here (cache hit, or joined from an identical in-flight
+        call) is yielded whole once the graph finishes.
+
+        Args:
+            request_id: Unique request identifier
+            user_message: The user's message
+            room_id: Matrix room the message was sent in
+
+        Yields:
+            Consecutive pieces of the AI response
+        """
+        initial_state = {
+            "messages": [HumanMessage(content=user_message)],
+            "request_id": request_id,
+            "room_id": room_id,
+            "stream": True,
+        }
+
+        logger.info(f"[{request_id}] Starting streaming graph execution")
+        streamed = False
+        final_state = None
+        async for mode, payload in self.graph.astream(
+            initial_state, config=self._run_config, stream_mode=["messages", "values"]
+        ):
+            if mode == "values":
+                final_state = payload
+                continue
+            chunk, _metadata = payload
+            # Only token chunks; whole messages returned by nodes arrive via "values"
+            if isinstance(chunk, AIMessageChunk) and chunk.content:
+                streamed = True
+                yield chunk.content
+
+        if not streamed:
+            yield self._final_answer(final_state)
+
+    @staticmethod
+    def _final_answer(final_state: Optional[dict]) -> str:
+        """Return the content of the last AI message in a final graph state."""
+        # Scan from the end, where the answer was just added, and stop at the first hit
+        messages = final_state["messages"] if final_state else ()
+        ai_msg = next((msg for msg in reversed(messages) if isinstance(msg, AIMessage)), None)
+        return ai_msg.content if ai_msg else "I apologize, but I couldn't generate a response."
@@ -0,0 +1,207 @@
+"""
+Request batching for independent LLM prompts.
+
+Prompts that arrive within a short window, come from the same room and
+share the same leading messages are marshalled into one numbered prompt, sent as a single LLM
+call, and the numbered answer is split back out to each caller. This
+trades a little latency (the window) for fewer provider requests when
+many independent first-turn questions arrive together.
+"""
+
+import asyncio
+import contextvars
+import logging
+import re
+from typing import NamedTuple, Optional, Sequence
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage
+
+logger = logging.getLogger(__name__)
+
+_ANSWER_MARKER_RE = re.compile(r"^\[(\d+)\][ \t]*", re.MULTILINE)
+
+# "[n]" anywhere in a question, rewritten so it cannot pose as a marker
+_MARKER_LIKE_RE = re.compile(r"\[(\d+)\]")
+
+_BATCH_INSTRUCTIONS = (
+    "Answer each numbered question below independently, as if it were asked on its own. "
+    "Start each answer on a new line with its number in square brackets, e.g. [1], "
+    "and do not use that marker anywhere else.\n\n"
+)
+
+
+class _Pending(NamedTuple):
+    """A prompt waiting to be answered."""
+    messages: list[BaseMessage]
+    future: asyncio.Future
+    # Caller's context; LangChain run and tracing state travels in contextvars
+    context: contextvars.Context
+    # Only prompts of the same group (room) may share a marshalled call
+    group: str
+
+
+def _inline_question(text: str) -> str:
+    """Flatten a question onto one line and defuse any "[n]" answer markers in it."""
+    return _MARKER_LIKE_RE.sub(r"(\1)", " ".join(text.splitlines()))
+
+
+class BatchingLLM:
+    """Coalesces concurrent independent prompts into shared LLM calls."""
+
+    def __init__(self, llm: BaseChatModel, window: float = 0.05, max_batch: int = 8):
+        """
+        Initialize the batcher.
+
+        Args:
+            llm: Chat model used for both batched and individual calls
+            window: Seconds to wait for more prompts after the first one arrives
+            max_batch: Maximum number of prompts marshalled into one call
+        """
+        self.llm = llm
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[_Pending] = asyncio.Queue()
+        self._collector: Optional[asyncio.Task] = None
+        self._batches: set[asyncio.Task] = set()
+
+    async def ainvoke(self, messages: Sequence[BaseMessage], group: str) -> str:
+        """
+        Get the completion for a prompt, possibly as part of a batch.
+
+        Args:
+            messages: Prompt messages; the last one must be the user's question
+            group: Isolation key (the room ID); prompts are only marshalled
+                together with prompts of the same group
+
+        Returns:
+            The completion content for this prompt
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Pending(list(messages), future, contextvars.copy_context(), group))
+        if self._collector is None or self._collector.done():
+            # The collector outlives the request that starts it, so it must not
+            # carry (and keep alive) that request's context; batch tasks it
+            # creates inherit this empty one
+            self._collector = asyncio.create_task(self._collect(), context=contextvars.Context())
+        return await future
+
+    async def aclose(self) -> None:
+        """Stop collecting prompts and cancel batches still in flight."""
+        tasks = [*self._batches]
+        if self._collector is not None:
+            tasks.append(self._collector)
+            self._collector = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not self._queue.empty():
+            self._queue.get_nowait().future.cancel()
+
+    async def _collect(self) -> None:
+        """Gather prompts into batches and dispatch each batch."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch: list[_Pending]) -> None:
+        """Answer a batch, one group (room) at a time."""
+        groups: dict[str, list[_Pending]] = {}
+        for item in batch:
+            groups.setdefault(item.group, []).append(item)
+        await asyncio.gather(*(self._run_group(items) for items in groups.values()))
+
+    async def _run_group(self, items: list[_Pending]) -> None:
+        """Answer prompts of one group, marshalling those that share a prefix into one call."""
+        prefix = items[0].messages[:-1]
+        shared, others = [], []
+        for item in items:
+            if item.messages[:-1] == prefix and isinstance(item.messages[-1], HumanMessage):
+                shared.append(item)
+            else:
+                others.append(item)
+
+        jobs = [self._run_single(item) for item in others]
+        if len(shared) > 1:
+            jobs.append(self._run_marshalled(prefix, shared))
+        else:
+            jobs.extend(self._run_single(item) for item in shared)
+        await asyncio.gather(*jobs)
+
+    async def _run_single(self, item: _Pending) -> None:
+        """Answer one prompt with its own LLM call, made in the caller's context."""
+        try:
+            response = await asyncio.create_task(
+                self.llm.ainvoke(item.messages), context=item.context.copy()
+            )
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+            return
+        if not item.future.done():
+            item.future.set_result(response.content)
+
+    async def _run_marshalled(
+        self,
+        prefix: list[BaseMessage],
+        items: list[_Pending],
+    ) -> None:
+        """
+        Answer several prompts with one numbered LLM call.
+
+        The shared call belongs to no single request, so it runs outside every
+        caller's context rather than being traced under one of them. Each
+        question is put on a single line with "[n]" markers defused, so its
+        text cannot shift the numbering or fake another question's answer.
+        """
+        questions = "\n".join(
+            f"[{i}] {_inline_question(item.messages[-1].content)}"
+            for i, item in enumerate(items, start=1)
+        )
+        try:
+            response = await self.llm.ainvoke(
+                [*prefix, HumanMessage(content=_BATCH_INSTRUCTIONS + questions)]
+            )
+        except Exception as e:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        answers = self._split_answers(response.content, len(items))
+        if answers is None:
+            # The model did not follow the numbering; answer individually.
+            logger.warning(f"Could not split batched answer for {len(items)} prompts, retrying individually")
+            await asyncio.gather(*(self._run_single(item) for item in items))
+            return
+
+        logger.info(f"Answered {len(items)} prompts with one LLM call")
+        for item, answer in zip(items, answers):
+            if not item.future.done():
+                item.future.set_result(answer)
+
+    @staticmethod
+    def _split_answers(content: str, count: int) -> Optional[list[str]]:
+        """Split a numbered batch answer, or return None if it is malformed."""
+        markers = list(_ANSWER_MARKER_RE.finditer(content))
+        if [int(m.group(1)) for m in markers] != list(range(1, count + 1)):
+            return None
+
+        answers = []
+        for i, marker in enumerate(markers):
+            end = markers[i + 1].start() if i + 1 < len(markers) else len(content)
+            answers.append(content[marker.end():end].strip())
+        return answers
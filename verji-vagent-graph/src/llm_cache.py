@@ -0,0 +1,134 @@
+"""
+Redis-backed response cache for LLM calls.
+
+Completions are stored under a SHA-256 of the model, sampling temperature
+and prompt messages, so a repeated prompt skips the OpenAI round trip.
+Recently used entries are also kept in process, so hot prompts skip the
+Redis round trip as well.
+"""
+
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+import redis.asyncio as redis
+from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """Exact-match cache of LLM responses stored in Redis."""
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        ttl: int = 3600,
+        prefix: str = "llm_cache:",
+        local_size: int = 512,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            redis_client: Connected async Redis client
+            ttl: Seconds a cached response stays valid
+            prefix: Key prefix for cache entries
+            local_size: Entries kept in the in-process LRU in front of Redis (0 disables it)
+        """
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local_size = local_size
+        # Key -> (monotonic expiry time, content), least recently used first
+        self._local: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    @staticmethod
+    def cache_key(model: str, messages: Sequence[BaseMessage], temperature: float) -> str:
+        """
+        Build the cache key for an LLM call.
+
+        Args:
+            model: Model name the request is sent to
+            messages: Prompt messages in the order sent to the LLM
+            temperature: Sampling temperature of the call
+
+        Returns:
+            Hex SHA-256 digest identifying the call
+        """
+        payload = {
+            "model": model,
+            "temperature": temperature,
+            "messages": [[msg.type, msg.content] for msg in messages],
+        }
+        encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response.
+
+        Redis errors and unreadable entries are logged and treated as a miss
+        so the caller falls back to the LLM.
+
+        Args:
+            key: Key returned by cache_key()
+
+        Returns:
+            The cached response content, or None on a miss
+        """
+        entry = self._local.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._local.move_to_end(key)
+                return entry[1]
+            del self._local[key]
+
+        try:
+            raw = await self.redis_client.get(self.prefix + key)
+        except redis.RedisError as e:
+            logger.warning(f"LLM cache lookup failed: {e}")
+            return None
+
+        if raw is None:
+            return None
+        try:
+            content = json.loads(raw)["content"]
+            if not isinstance(content, str):
+                raise TypeError(f"content is {type(content).__name__}, not str")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring malformed LLM cache entry {key}: {e}")
+            return None
+        # May outlive the Redis copy by up to ttl; harmless for deterministic completions
+        self._remember(key, content)
+        return content
+
+    async def set(self, key: str, content: str) -> None:
+        """
+        Store a response in the cache.
+
+        Args:
+            key: Key returned by cache_key()
+            content: The response content to cache
+        """
+        self._remember(key, content)
+        try:
+            await self.redis_client.set(
+                self.prefix + key,
+                json.dumps({"content": content}),
+                ex=self.ttl,
+            )
+        except redis.RedisError as e:
+            logger.warning(f"LLM cache store failed: {e}")
+
+    def _remember(self, key: str, content: str) -> None:
+        """Store a response in the in-process LRU, evicting the oldest entry if full."""
+        if self.local_size <= 0:
+            return
+        self._local[key] = (time.monotonic() + self.ttl, content)
+        self._local.move_to_end(key)
+        if len(self._local) > self.local_size:
+            self._local.popitem(last=False)
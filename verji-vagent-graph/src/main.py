@@ -6,28 +6,95 @@ using a LangGraph workflow with OpenAI LLM.
 """
 
 import asyncio
-import json
 import logging
 import os
+import signal
 import sys
-from typing import Any, Dict
 
+import msgspec
 import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 from dotenv import load_dotenv
 from pathlib import Path
 from graph import VerjiAgent
+from llm_cache import LLMCache
+from schemas import REQUEST_DECODER, GraphRequest, RequestMetadata
 
-# Load environment variables from .env file in project root
-env_path = Path(__file__).parent.parent.parent / ".env"
-load_dotenv(dotenv_path=env_path)
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger(__name__)
 
+_json_encode = msgspec.json.Encoder().encode
+
+_REQUEST_CHANNEL = "vagent:requests"
+
+# Maximum number of queued responses sent in one publish pipeline
+_PUBLISH_BATCH_MAX = 256
+
+# Upper bound in seconds on the wait between pubsub reconnect attempts
+_RECONNECT_BACKOFF_MAX = 30
+
+# Response envelope with the fixed keys pre-rendered; only the variable
+# fields are JSON-encoded per message.
+_MESSAGE_TEMPLATE = b'{"request_id":%s,"message_type":"%s","content":%s}'
+
+
+def _encode_message(request_id: str, message_type: bytes, content: str) -> bytes:
+    """Serialize a response message for the response channel."""
+    return _MESSAGE_TEMPLATE % (_json_encode(request_id), message_type, _json_encode(content))
+
+
+def _request_channels(shards: int, owned: str) -> list[str]:
+    """
+    Resolve the request channels this instance subscribes to.
+
+    With a single shard (or 0), requests use the plain "vagent:requests" channel.
+    With N shards, vagent-bot publishes each request to
+    "vagent:requests:{k}" (k derived from the request ID, see
+    redis_client.rs), and each instance subscribes to the shards it owns.
+
+    Args:
+        shards: Total number of request shards (REQUEST_SHARDS)
+        owned: Comma-separated shard indices to consume; empty means all
+
+    Returns:
+        The channel names to subscribe to
+
+    Raises:
+        ValueError: If shards is negative, an owned index is not an integer
+            in [0, shards), or the owned list names no shard at all
+    """
+    if shards < 0:
+        raise ValueError(f"REQUEST_SHARDS must not be negative, got {shards}")
+    if shards <= 1:
+        return [_REQUEST_CHANNEL]
+    if not owned.strip():
+        return [f"{_REQUEST_CHANNEL}:{i}" for i in range(shards)]
+
+    # A shard nobody consumes only shows up as bot-side timeouts, so refuse
+    # to start with a mistyped shard list
+    indices: list[int] = []
+    for part in owned.split(","):
+        if not part.strip():
+            continue
+        try:
+            index = int(part)
+        except ValueError:
+            raise ValueError(f"REQUEST_SHARDS_OWNED: {part.strip()!r} is not a shard index") from None
+        if not 0 <= index < shards:
+            raise ValueError(
+                f"REQUEST_SHARDS_OWNED: shard {index} is out of range for REQUEST_SHARDS={shards}"
+            )
+        if index not in indices:
+            indices.append(index)
+    if not indices:
+        raise ValueError(f"REQUEST_SHARDS_OWNED: {owned!r} names no shard")
+    return [f"{_REQUEST_CHANNEL}:{i}" for i in indices]
+
 
 class VAgentGraph:
     """Main service class for the vAgent Graph service."""
@@ -35,38 +102,182 @@ class VAgentGraph:
     def __init__(self):
         """Initialize the service."""
         self.redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-        self.request_channel = "vagent:requests"
+        self.request_channels = _request_channels(
+            # Unset or blank means unsharded, as in vagent-bot
+            int(os.getenv("REQUEST_SHARDS", "").strip() or "1"),
+            os.getenv("REQUEST_SHARDS_OWNED", ""),
+        )
         self.response_channel = "vagent:responses"
+        # Connections per pool; requests wait up to 5 s for a free one
+        self.redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+        # Pubsub subscription and response publishing
         self.redis_client: redis.Redis | None = None
+        # LLM response cache lookups, kept apart so they never starve publishing
+        self.cache_client: redis.Redis | None = None
         self.pubsub: redis.client.PubSub | None = None
         self.agent: VerjiAgent | None = None
+        # Number of dispatch workers, i.e. the cap on concurrently processed
+        # requests (and so concurrent OpenAI calls)
+        self.max_inflight = int(os.getenv("MAX_INFLIGHT", "16"))
+        # Send the answer paragraph by paragraph as the LLM generates it
+        self.stream_responses = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+        # Raw request payloads waiting for a worker; when full, the reader
+        # stops pulling from pubsub until a worker frees up
+        self._request_queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=1024)
+        self._workers: list[asyncio.Task] = []
+        self._inflight = 0
+        # Encoded responses waiting to be published by the publisher task.
+        # Bounded so a slow Redis pauses emitting requests instead of
+        # letting responses pile up in memory.
+        self._publish_queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=1024)
+        self._publisher: asyncio.Task | None = None
+        self._running = False
 
     async def connect(self):
         """Connect to Redis and initialize LangGraph agent."""
         logger.info(f"Connecting to Redis at {self.redis_url}")
-        self.redis_client = await redis.from_url(
-            self.redis_url,
-            encoding="utf-8",
-            decode_responses=True,
-        )
+        # Pubsub payloads stay raw bytes: msgspec parses them without a str round trip
+        self.redis_client = redis.Redis(connection_pool=self._create_pool(decode_responses=False))
+        self.cache_client = redis.Redis(connection_pool=self._create_pool(decode_responses=True))
         self.pubsub = self.redis_client.pubsub()
-        await self.pubsub.subscribe(self.request_channel)
-        logger.info(f"Subscribed to channel: {self.request_channel}")
+        await self.pubsub.subscribe(*self.request_channels)
+        logger.info(f"Subscribed to channels: {', '.join(self.request_channels)}")
+        self._publisher = asyncio.create_task(self._publisher_loop())
+        self._publisher.add_done_callback(self._on_publisher_done)
 
         # Initialize LangGraph agent with emit_progress callback
         logger.info("Initializing LangGraph agent with OpenAI...")
-        self.agent = VerjiAgent(emit_progress_callback=self.emit_progress)
+        cache = LLMCache(
+            self.cache_client,
+            ttl=int(os.getenv("LLM_CACHE_TTL", "3600")),
+            local_size=int(os.getenv("LLM_CACHE_LOCAL_SIZE", "512")),
+        )
+        self.agent = VerjiAgent(
+            emit_progress_callback=self.emit_progress,
+            cache=cache,
+        )
         logger.info("LangGraph agent initialized")
 
+        self._workers = [
+            asyncio.create_task(self._dispatch_worker()) for _ in range(self.max_inflight)
+        ]
+        logger.info(f"Started {self.max_inflight} dispatch workers")
+
     async def disconnect(self):
-        """Disconnect from Redis."""
+        """Finish outstanding requests, stop dispatch workers and disconnect from Redis."""
+        if self._workers:
+            # Let queued and in-flight requests complete before stopping workers
+            try:
+                await asyncio.wait_for(self._request_queue.join(), timeout=30.0)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Abandoning {self._inflight} in-flight and "
+                    f"{self._request_queue.qsize()} queued requests"
+                )
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.agent:
+            await self.agent.aclose()
+        if self._publisher:
+            # Flush responses that are still queued before closing the connection
+            try:
+                await asyncio.wait_for(self._publish_queue.join(), timeout=5.0)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {self._publish_queue.qsize()} unpublished responses")
+            self._publisher.cancel()
+            await asyncio.gather(self._publisher, return_exceptions=True)
+            self._publisher = None
         if self.pubsub:
-            await self.pubsub.unsubscribe(self.request_channel)
-            await self.pubsub.close()
-        if self.redis_client:
-            await self.redis_client.close()
+            await self.pubsub.unsubscribe(*self.request_channels)
+            await self.pubsub.aclose()
+        for client in (self.redis_client, self.cache_client):
+            if client:
+                await client.aclose()
+                await client.connection_pool.disconnect()
         logger.info("Disconnected from Redis")
 
+    def _create_pool(self, decode_responses: bool) -> redis.BlockingConnectionPool:
+        """Create a bounded Redis connection pool for one kind of traffic."""
+        return redis.BlockingConnectionPool.from_url(
+            self.redis_url,
+            max_connections=self.redis_max_connections,
+            timeout=5,
+            encoding="utf-8",
+            decode_responses=decode_responses,
+            # RESP3 delivers pubsub messages as push frames, parsed by hiredis
+            protocol=3,
+            # Reconnect transparently on transient connection errors
+            retry=Retry(ExponentialBackoff(cap=_RECONNECT_BACKOFF_MAX), 3),
+            retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+            # Detect dead sockets before the next command or message needs them
+            socket_keepalive=True,
+            health_check_interval=30,
+        )
+
+    async def _resubscribe(self):
+        """
+        Re-establish the pubsub subscription after its connection was lost.
+
+        Retries with exponential backoff (capped at 30 s) until the
+        subscription is restored or the service is stopping.
+        """
+        attempt = 0
+        while self._running:
+            delay = min(2 ** attempt, _RECONNECT_BACKOFF_MAX)
+            logger.warning(f"Reconnecting pubsub in {delay}s")
+            await asyncio.sleep(delay)
+            try:
+                # Drops the dead connection and subscription state; the pubsub
+                # object stays usable and subscribe() takes a fresh connection
+                await self.pubsub.aclose()
+                await self.pubsub.subscribe(*self.request_channels)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                logger.warning(f"Pubsub reconnect failed: {e}")
+                attempt += 1
+                continue
+            logger.info(f"Resubscribed to channels: {', '.join(self.request_channels)}")
+            return
+
+    async def _publisher_loop(self):
+        """
+        Publish queued responses, pipelining everything queued at once.
+
+        Responses that pile up while a pipeline is in flight go out together
+        in the next one, so a burst of emits costs one round trip instead of
+        one per message. A single publisher keeps responses in emit order.
+        """
+        while True:
+            batch = [await self._publish_queue.get()]
+            while len(batch) < _PUBLISH_BATCH_MAX:
+                try:
+                    batch.append(self._publish_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for payload in batch:
+                    pipe.publish(self.response_channel, payload)
+                await pipe.execute()
+            except redis.RedisError as e:
+                logger.error(f"Failed to publish {len(batch)} responses: {e}")
+            except Exception as e:
+                # The publisher is the only consumer of the bounded queue; if
+                # it died, every emit would eventually block forever
+                logger.error(f"Unexpected error publishing {len(batch)} responses: {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    self._publish_queue.task_done()
+
+    def _on_publisher_done(self, task: asyncio.Task) -> None:
+        """Shut the service down if the publisher ever exits other than by cancellation."""
+        if task.cancelled():
+            return
+        logger.error("Response publisher stopped unexpectedly, shutting down", exc_info=task.exception())
+        self.stop()
+
     async def emit_progress(self, request_id: str, content: str) -> None:
         """
         Emit a progress notification for streaming updates.
@@ -75,15 +286,7 @@ class VAgentGraph:
             request_id: The request ID to associate with this progress update
             content: The progress message content
         """
-        message = {
-            "request_id": request_id,
-            "message_type": "progress",
-            "content": content,
-        }
-        await self.redis_client.publish(
-            self.response_channel,
-            json.dumps(message),
-        )
+        await self._publish_queue.put(_encode_message(request_id, b"progress", content))
         logger.debug(f"Emitted progress for request {request_id}: {content}")
 
     async def emit_final_response(self, request_id: str, content: str) -> None:
@@ -94,37 +297,28 @@ class VAgentGraph:
             request_id: The request ID to associate with this response
             content: The final response content
         """
-        message = {
-            "request_id": request_id,
-            "message_type": "final_response",
-            "content": content,
-        }
-        await self.redis_client.publish(
-            self.response_channel,
-            json.dumps(message),
-        )
+        await self._publish_queue.put(_encode_message(request_id, b"final_response", content))
         logger.info(f"Emitted final response for request {request_id}")
 
     async def emit_error(self, request_id: str, error_message: str) -> None:
         """
         Emit an error response.
 
+        Never waits: the failure path must not stall on a backed-up publisher,
+        so if the publish queue is full the error is logged and dropped.
+
         Args:
             request_id: The request ID to associate with this error
             error_message: The error message
         """
-        message = {
-            "request_id": request_id,
-            "message_type": "error",
-            "content": error_message,
-        }
-        await self.redis_client.publish(
-            self.response_channel,
-            json.dumps(message),
-        )
+        try:
+            self._publish_queue.put_nowait(_encode_message(request_id, b"error", error_message))
+        except asyncio.QueueFull:
+            logger.error(f"Publish queue full, dropped error for request {request_id}: {error_message}")
+            return
         logger.error(f"Emitted error for request {request_id}: {error_message}")
 
-    async def process_query(self, request_id: str, query: str, metadata: Dict[str, Any]) -> None:
+    async def process_query(self, request_id: str, query: str, metadata: RequestMetadata) -> None:
         """
         Process a query from vagent-bot using LangGraph with streaming progress.
 
@@ -138,7 +332,10 @@ class VAgentGraph:
 
         try:
             # Process through LangGraph agent (it will emit progress updates)
-            response = await self.agent.process(request_id, query)
+            if self.stream_responses:
+                response = await self._stream_response(request_id, query, metadata.room_id)
+            else:
+                response = await self.agent.process(request_id, query, metadata.room_id)
 
             # Emit final response
             await self.emit_final_response(request_id, response)
@@ -147,11 +344,45 @@ class VAgentGraph:
             logger.error(f"Error processing query: {e}", exc_info=True)
             await self.emit_error(request_id, f"Failed to process query: {str(e)}")
 
-    async def handle_request(self, message_data: Dict[str, Any]):
+    async def _stream_response(self, request_id: str, query: str, room_id: str) -> str:
+        """
+        Stream the agent's answer, emitting completed paragraphs as progress.
+
+        vagent-bot posts every progress update as its own room message, so
+        tokens are grouped into paragraphs rather than sent one by one. The
+        last paragraph is held back and returned as the final response.
+
+        Args:
+            request_id: The request ID for correlation
+            query: The user's query text
+            room_id: Matrix room the query was sent in
+
+        Returns:
+            The part of the answer not yet emitted as progress
+        """
+        held = ""  # last completed paragraph, emitted once another one completes
+        tail = ""  # text after the last paragraph break
+        async for chunk in self.agent.process_stream(request_id, query, room_id):
+            tail += chunk
+            completed, _, tail = tail.rpartition("\n\n")
+            completed = completed.strip()
+            if completed:
+                if held:
+                    await self.emit_progress(request_id, held)
+                held = completed
+
+        tail = tail.strip()
+        if not tail:
+            return held
+        if held:
+            await self.emit_progress(request_id, held)
+        return tail
+
+    async def handle_request(self, request: GraphRequest):
         """
         Handle an incoming request from vagent-bot.
 
-        Expected message format:
+        Decoded from a message of the format:
         {
             "request_id": "unique-id",
             "query": "user query text",
@@ -162,49 +393,102 @@ class VAgentGraph:
             }
         }
         """
-        try:
-            request_id = message_data.get("request_id")
-            query = message_data.get("query", "")
-            metadata = message_data.get("metadata", {})
+        if not request.request_id:
+            logger.error("Missing request_id in message")
+            return
 
-            if not request_id:
-                logger.error("Missing request_id in message")
-                return
-
-            logger.info(f"Handling request {request_id}")
+        try:
+            logger.info(f"Handling request {request.request_id}")
 
             # Process the query with streaming support
-            await self.process_query(request_id, query, metadata)
+            await self.process_query(request.request_id, request.query, request.metadata)
 
         except Exception as e:
             logger.error(f"Error handling request: {e}", exc_info=True)
             # Emit error message
-            if message_data.get("request_id"):
-                await self.emit_error(
-                    message_data["request_id"],
-                    f"Error processing your request: {str(e)}"
-                )
+            await self.emit_error(
+                request.request_id,
+                f"Error processing your request: {str(e)}"
+            )
+
+    async def _reject_invalid(self, raw: bytes, error: msgspec.ValidationError):
+        """Report a well-formed but invalid request back to its sender, if identifiable."""
+        logger.error(f"Invalid request: {error}")
+        try:
+            request_id = msgspec.json.decode(raw).get("request_id")
+        except (msgspec.DecodeError, AttributeError):
+            return
+        if request_id and isinstance(request_id, str):
+            await self.emit_error(request_id, f"Invalid request: {error}")
+
+    async def _dispatch_worker(self):
+        """Decode and handle queued requests, one at a time."""
+        # Bound once: these run for every request
+        decode = REQUEST_DECODER.decode
+        queue = self._request_queue
+        handle = self.handle_request
+
+        while True:
+            raw = await queue.get()
+            try:
+                request = decode(raw)
+            except msgspec.ValidationError as e:
+                await self._reject_invalid(raw, e)
+                queue.task_done()
+                continue
+            except msgspec.DecodeError as e:
+                logger.error(f"Failed to decode message: {e}")
+                queue.task_done()
+                continue
+
+            self._inflight += 1
+            logger.debug(f"In-flight requests: {self._inflight}/{self.max_inflight}")
+            try:
+                await handle(request)
+            except Exception as e:
+                logger.error(f"Error processing message: {e}", exc_info=True)
+            finally:
+                self._inflight -= 1
+                queue.task_done()
 
     async def run(self):
         """Main run loop - listen for requests and process them."""
         logger.info("🚀 vAgent Graph service starting...")
 
+        # Set before connecting, so a SIGTERM that arrives while connecting
+        # is not overwritten and the loop below never starts
+        self._running = True
         try:
             await self.connect()
 
             logger.info("✅ Service ready - listening for requests")
 
-            # Listen for messages
-            async for message in self.pubsub.listen():
-                if message["type"] == "message":
-                    try:
-                        data = json.loads(message["data"])
-                        # Process each request in a background task
-                        asyncio.create_task(self.handle_request(data))
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Failed to decode message: {e}")
-                    except Exception as e:
-                        logger.error(f"Error processing message: {e}", exc_info=True)
+            # Bound once: these run for every message. The pubsub object
+            # survives resubscribes, so its bound method stays valid.
+            get_message = self.pubsub.get_message
+            queue = self._request_queue
+            enqueue = queue.put
+
+            # Listen for messages; subscribe confirmations are filtered out
+            while self._running:
+                try:
+                    message = await get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    # Drain everything already buffered before waiting again
+                    while message is not None:
+                        # Hand off to the dispatch workers; blocks while the queue is full
+                        if queue.full():
+                            logger.warning(
+                                f"Request queue full ({queue.maxsize}), "
+                                f"waiting for {self.max_inflight} busy workers"
+                            )
+                        await enqueue(message["data"])
+                        message = await get_message(ignore_subscribe_messages=True, timeout=0.0)
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    # Keep serving: requests in the queue carry on while we resubscribe
+                    logger.error(f"Lost pubsub connection: {e}")
+                    await self._resubscribe()
+
+            logger.info("Received shutdown signal")
 
         except KeyboardInterrupt:
             logger.info("Received shutdown signal")
@@ -215,12 +499,38 @@ class VAgentGraph:
             await self.disconnect()
             logger.info("Service stopped")
 
+    def stop(self):
+        """Ask the run loop to stop accepting requests and shut down."""
+        self._running = False
+
 
 async def main():
     """Entry point for the service."""
+    # Load environment variables from .env file in project root
+    env_path = Path(__file__).parent.parent.parent / ".env"
+    load_dotenv(dotenv_path=env_path)
+
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
     service = VAgentGraph()
+    try:
+        # Kubernetes stops pods with SIGTERM; shut down gracefully
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, service.stop)
+    except NotImplementedError:  # Signal handlers are unavailable on Windows
+        pass
     await service.run()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # libuv-backed event loop: cheaper socket I/O for pubsub and LLM calls
+    if uvloop is None:
+        asyncio.run(main())
+    elif sys.version_info >= (3, 12):
+        asyncio.run(main(), loop_factory=uvloop.new_event_loop)
+    else:
+        uvloop.install()
+        asyncio.run(main())
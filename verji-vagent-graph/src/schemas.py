@@ -0,0 +1,30 @@
+"""
+Message types exchanged with verji-vagent-bot over Redis.
+
+These mirror the serde structs in verji-vagent-bot/src/redis_client.rs;
+keep both sides in sync when changing a field.
+
+msgspec structs are slotted (no per-instance __dict__); they are also
+frozen, since a decoded request is never modified, which makes them
+hashable.
+"""
+
+import msgspec
+
+
+class RequestMetadata(msgspec.Struct, frozen=True):
+    """Metadata about the request."""
+    room_id: str = ""
+    user_id: str = ""
+    timestamp: int = 0
+
+
+class GraphRequest(msgspec.Struct, frozen=True):
+    """Request sent by vagent-bot for processing."""
+    request_id: str
+    query: str = ""
+    metadata: RequestMetadata = msgspec.field(default_factory=RequestMetadata)
+
+
+# Decodes JSON bytes straight into a validated GraphRequest in one C pass
+REQUEST_DECODER = msgspec.json.Decoder(GraphRequest)
@@ -0,0 +1,47 @@
+"""Tests for resolving the request channels an instance subscribes to."""
+
+import pytest
+
+from main import _request_channels
+
+
+def test_unsharded_uses_plain_channel():
+    assert _request_channels(1, "") == ["vagent:requests"]
+    assert _request_channels(0, "") == ["vagent:requests"]
+
+
+def test_sharded_without_owned_list_takes_all_shards():
+    assert _request_channels(3, "") == [
+        "vagent:requests:0",
+        "vagent:requests:1",
+        "vagent:requests:2",
+    ]
+
+
+def test_owned_list_selects_shards():
+    assert _request_channels(4, " 3, 1 ") == ["vagent:requests:3", "vagent:requests:1"]
+
+
+def test_owned_list_drops_duplicates():
+    assert _request_channels(4, "1,1,2,1") == ["vagent:requests:1", "vagent:requests:2"]
+
+
+@pytest.mark.parametrize("owned", ["4", "-1", "0,9"])
+def test_owned_index_out_of_range_is_rejected(owned):
+    with pytest.raises(ValueError, match="out of range"):
+        _request_channels(4, owned)
+
+
+def test_owned_index_not_an_integer_is_rejected():
+    with pytest.raises(ValueError, match="not a shard index"):
+        _request_channels(4, "one")
+
+
+def test_owned_list_naming_no_shard_is_rejected():
+    with pytest.raises(ValueError, match="names no shard"):
+        _request_channels(4, ",")
+
+
+def test_negative_shard_count_is_rejected():
+    with pytest.raises(ValueError, match="must not be negative"):
+        _request_channels(-2, "")